@@ -13,8 +13,7 @@ SWENG861 Project, AskMinstrel
 The project directly makes use of the following packages:  
 [CherryPy](https://pypi.org/project/CherryPy/) A Python HTTP framework and server.  
 [Tekore](https://pypi.org/project/tekore/) A Python client for the Spotify API.  
-[Requests](https://pypi.org/project/requests/) A library for HTTP/1.1 requests.  
-[Slugify](https://pypi.org/project/python-slugify/) Generate URI compatible strings.  
+[orjson](https://pypi.org/project/orjson/) Fast JSON serialization.  
 
 Content provided by [Spotify](https://developer.spotify.com/)
 
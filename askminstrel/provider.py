@@ -8,14 +8,32 @@ SWENG861 Project, AskMinstrel
 
 """
 # pylint: disable=bad-continuation, invalid-name
+import hashlib
 import logging
 import json
+import operator
 import pickle
 import shutil
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from functools import singledispatch, wraps
+from functools import wraps
 import tekore
-from slugify import slugify
+
+_log = logging.getLogger(__name__)
+
+try:
+    import orjson
+    def _json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    _json_loads = orjson.loads
+except ImportError:
+    # stdlib fallback, slower but always available
+    def _json_dumps(obj):
+        return json.dumps(obj).encode()
+    _json_loads = json.loads
 
 CACHE = Path.cwd()/'cache'
 TOKEN = CACHE/'token.pickle'
@@ -32,164 +50,218 @@ CREDENTIALS = Path.cwd()/'credentials.json'
 # a `flatten object` for any nested tekore containers.
 #
 
-def _filtered_dict(model, include_keys):
-    """ Create a flattened dict from `model` with only `include_keys`. """
-    return {key:flatten_object_from(model.__dict__.get(key)) for key in include_keys}
+# values that are already serializable pass through the filters untouched,
+# skipping both the dispatch lookup and the raise/catch in _flatten_default
+_SCALAR_TYPES = frozenset((str, int, float, bool, type(None)))
+
+def _make_filter(*include_keys):
+    """ Compile a flattening filter specialized to fixed `include_keys`.
+
+    The attrgetter and key tuple are bound once at module load so each call
+    is a straight zip over the extracted values, no per-call key lookups.
+    Scalar values, the large majority of model fields, bypass the flatten
+    dispatch entirely.
+    """
+    getter = operator.attrgetter(*include_keys)
+    def _filter(model):
+        values = getter(model) if len(include_keys) > 1 else (getter(model),)
+        return {key:value if type(value) in _SCALAR_TYPES else flatten_object_from(value)
+            for key, value in zip(include_keys, values)}
+    return _filter
+
+def _resolve_mro(cls, registry):
+    """ Find the nearest registered handler for `cls` and memoize it.
+
+    Walked once per concrete type; subsequent calls hit the registry dict
+    directly.  The `object` entry acts as the fallback handler.
+    """
+    handler = next(registry[base] for base in cls.__mro__ if base in registry)
+    registry[cls] = handler
+    return handler
 
 #
 # search_object_from
 #
-@singledispatch
-def search_object_from(result):
-    """ Convert tekore models to application specific serializable objects. """
+def _search_default(result):
     raise NotImplementedError(type(result))
 
-@search_object_from.register(tekore.model.Paging)
-def _(result):
+def _search_paging(result):
     return [search_object_from(item) for item in result.items]
 
-@search_object_from.register(tekore.model.FullArtist)
-def _(result):
-    include_keys = ['id', 'name', 'genres', 'images']
-    return _filtered_dict(result, include_keys)
-
-@search_object_from.register(tekore.model.SimpleAlbum)
-def _(result):
-    include_keys = ['id', 'name', 'artists', 'release_date', 'images']
-    return _filtered_dict(result, include_keys)
-
-@search_object_from.register(tekore.model.FullTrack)
-def _(result):
-    include_keys = ['id', 'name', 'artists', 'album']
-    return _filtered_dict(result, include_keys)
+_SEARCH = {
+    object: _search_default,
+    tekore.model.Paging: _search_paging,
+    tekore.model.FullArtist: _make_filter('id', 'name', 'genres', 'images'),
+    tekore.model.SimpleAlbum: _make_filter('id', 'name', 'artists', 'release_date', 'images'),
+    tekore.model.FullTrack: _make_filter('id', 'name', 'artists', 'album'),
+    tekore.model.SimpleTrack: _make_filter('id', 'name', 'disc_number', 'track_number',
+        'duration_ms'),
+}
 
-@search_object_from.register(tekore.model.SimpleTrack)
-def _(result):
-    include_keys = ['id', 'name', 'disc_number', 'track_number', 'duration_ms']
-    return _filtered_dict(result, include_keys)
+def search_object_from(result):
+    """ Convert tekore models to application specific serializable objects. """
+    handler = _SEARCH.get(type(result)) or _resolve_mro(type(result), _SEARCH)
+    return handler(result)
 
 #
 # detail_object_from
 #
-@singledispatch
-def detail_object_from(result):
-    """ Convert tekore models to application specific serializable objects. """
+def _detail_default(result):
     raise NotImplementedError
 
-@detail_object_from.register(tekore.model.FullArtist)
-def _(result):
-    include_keys = ['id', 'name', 'popularity', 'genres', 'images']
-    return _filtered_dict(result, include_keys)
-
-@detail_object_from.register(tekore.model.FullAlbum)
-def _(result):
-    include_keys = ['id', 'name', 'popularity', 'genres', 'release_date', 'total_tracks',
-        'label', 'artists', 'images']
-    return _filtered_dict(result, include_keys)
-
-@detail_object_from.register(tekore.model.FullTrack)
-def _(result):
-    include_keys = ['id', 'name', 'popularity', 'disc_number', 'track_number',
-        'artists', 'album', 'duration_ms']
-    return _filtered_dict(result, include_keys)
-
-@detail_object_from.register(tekore.model.AudioFeatures)
-def _(result):
-    include_keys = ['danceability', 'energy', 'valence'] 
+_DETAIL = {
+    object: _detail_default,
+    tekore.model.FullArtist: _make_filter('id', 'name', 'popularity', 'genres', 'images'),
+    tekore.model.FullAlbum: _make_filter('id', 'name', 'popularity', 'genres',
+        'release_date', 'total_tracks', 'label', 'artists', 'images'),
+    tekore.model.FullTrack: _make_filter('id', 'name', 'popularity', 'disc_number',
+        'track_number', 'artists', 'album', 'duration_ms'),
     # additional candidates: 'acousticness', 'instrumentalness', 'liveness'
-    return _filtered_dict(result, include_keys)
+    tekore.model.AudioFeatures: _make_filter('danceability', 'energy', 'valence'),
+}
+
+def detail_object_from(result):
+    """ Convert tekore models to application specific serializable objects. """
+    handler = _DETAIL.get(type(result)) or _resolve_mro(type(result), _DETAIL)
+    return handler(result)
 
 #
 # flatten_object_from
 #
-@singledispatch
-def flatten_object_from(result):
-    """ Convert tekore models to application specific serializable objects. """
+def _flatten_default(result):
     try:
         return result.json()
     except AttributeError:
         return result
 
-@flatten_object_from.register(tekore.model.Paging)
-def _(result):
+def _flatten_paging(result):
     raise NotImplementedError(type(result))
 
-@flatten_object_from.register(tekore.model.ModelList)
-def _(result):
+def _flatten_model_list(result):
     """ convert tekore paging model to a single serializable objects """
     try:
         return flatten_object_from(result[0])
     except IndexError:
         return None
 
-@flatten_object_from.register(tekore.model.Image)
-def _(result):
+def _flatten_image(result):
     return result.__dict__['url']
 
-@flatten_object_from.register(tekore.model.Item)
-def _(result):
+def _flatten_item(result):
     # model.Item will have id, type but maybe not name so use .get() not []
     return {k:result.__dict__.get(k) for k in ('id', 'type', 'name')}
 
+_FLATTEN = {
+    object: _flatten_default,
+    tekore.model.Paging: _flatten_paging,
+    tekore.model.ModelList: _flatten_model_list,
+    tekore.model.Image: _flatten_image,
+    tekore.model.Item: _flatten_item,
+}
 
-def permacache(f):
-    """ decorator to memoize api calls using on disk storage
-
-    returned api objects are pickled to a file name constructed from the
-    wrapped function name and the keyword arguments, positional args ignored
-    """
-    def _construct_cache_name(prefix, options):
-        return (CACHE/slugify(
-            ' '.join((prefix, str(sorted(options.items()))))
-            )).with_suffix('.pickle')
-
-    @wraps(f)
-    def _wrapper(*args, **kwargs):
-        filename = _construct_cache_name(f.__name__, kwargs)
-        logging.debug('cache name resolved as %s', filename)
-        if filename.exists():
-            with filename.open('rb') as fp:
-                api_result = pickle.load(fp)
-            logging.info('retrieved %s from cache', filename.name)
-        else:
-            api_result = f(*args, **kwargs)
-            with filename.open('wb') as fp:
-                pickle.dump(api_result, fp)
-            logging.info('cached new %s from api', filename.name)
-        return api_result
-    return _wrapper
-
-class TekoreAdaptor(tekore.Spotify):
-    """ subclass the api module to give decorater access to its methods """
-    # pylint: disable=arguments-differ
-
-    @permacache
-    def search(self, **kwargs):
-        return super().search(**kwargs)
-
-    @permacache
-    def artist(self, **kwargs):
-        return super().artist(**kwargs)
-
-    @permacache
-    def artist_albums(self, **kwargs):
-        return super().artist_albums(**kwargs)
+def flatten_object_from(result):
+    """ Convert tekore models to application specific serializable objects. """
+    handler = _FLATTEN.get(type(result)) or _resolve_mro(type(result), _FLATTEN)
+    return handler(result)
 
-    @permacache
-    def album(self, **kwargs):
-        return super().album(**kwargs)
 
-    @permacache
-    def album_tracks(self, **kwargs):
-        return super().album_tracks(**kwargs)
+_CACHE_DB = None
 
-    @permacache
-    def track(self, **kwargs):
-        return super().track(**kwargs)
+def _cache_db():
+    """ Lazily open the single shared cache connection.
 
-    @permacache
-    def track_audio_features(self, **kwargs):
-        return super().track_audio_features(**kwargs)
+    Returns None when the cache dir is absent (--no-store), so callers just
+    skip the cache.  WAL mode with relaxed sync amortizes the per-entry
+    open/fsync cost of the old file-per-key store.
+    """
+    global _CACHE_DB  # pylint: disable=global-statement
+    if _CACHE_DB is None:
+        try:
+            _CACHE_DB = sqlite3.connect(
+                f'file:{CACHE/"cache.db"}?mode=rwc', uri=True, isolation_level=None,
+                check_same_thread=False)
+        except sqlite3.OperationalError:
+            # cache dir erased by --no-store
+            return None
+        _CACHE_DB.execute('PRAGMA journal_mode=WAL')
+        _CACHE_DB.execute('PRAGMA synchronous=NORMAL')
+        _CACHE_DB.execute('CREATE TABLE IF NOT EXISTS cache(k BLOB PRIMARY KEY, v BLOB)')
+    return _CACHE_DB
+
+# in-process LRU shared by all permacached functions, so hot keys skip the
+# sqlite read and JSON parse entirely
+_MEMO = OrderedDict()
+_MEMO_SIZE = 512
+
+# one lock serializes the memo and the shared sqlite connection; cherrypy
+# worker threads and the Provider pool all pass through permacache
+_CACHE_LOCK = threading.Lock()
+
+def permacache(transform=None):
+    """ decorator factory to memoize api calls in a single sqlite store
+
+    api results are reduced to serializable objects by `transform` and stored
+    as JSON blobs keyed by the blake2b digest of the wrapped function name
+    and the keyword arguments, positional args ignored.  A small in-memory
+    LRU fronts the sqlite store for repeatedly requested keys.
+    """
+    def _construct_cache_key(prefix, options):
+        return hashlib.blake2b(
+            f'{prefix}{sorted(options.items())}'.encode(), digest_size=16).digest()
+
+    def _decorator(f):
+        @wraps(f)
+        def _wrapper(*args, **kwargs):
+            memo_key = (f.__name__, tuple(sorted(kwargs.items())))
+            key = _construct_cache_key(f.__name__, kwargs)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug('cache key resolved as %s', key.hex())
+            with _CACHE_LOCK:
+                # the memo is a layer of memoization too, so honor --no-store
+                # (absent cache dir) by skipping it along with the sqlite store
+                db = _cache_db()
+                if db is not None:
+                    try:
+                        _MEMO.move_to_end(memo_key)
+                        return _MEMO[memo_key]
+                    except KeyError:
+                        pass
+                row = db.execute(
+                    'SELECT v FROM cache WHERE k=?', (key,)).fetchone() if db else None
+
+            if row is not None:
+                api_result = _json_loads(row[0])
+                _log.info('retrieved %s from cache', f.__name__)
+            else:
+                # the api call itself runs unlocked so slow requests do not
+                # serialize unrelated cache traffic
+                api_result = f(*args, **kwargs)
+                if transform is not None:
+                    api_result = transform(api_result)
+
+            if db is None:
+                _log.debug('no cache dir, result not cached')
+                return api_result
+
+            with _CACHE_LOCK:
+                if row is None:
+                    db.execute('INSERT OR REPLACE INTO cache(k, v) VALUES (?, ?)',
+                        (key, _json_dumps(api_result)))
+                    _log.info('cached new %s from api', f.__name__)
+                _MEMO[memo_key] = api_result
+                if len(_MEMO) > _MEMO_SIZE:
+                    _MEMO.popitem(last=False)
+            return api_result
+        return _wrapper
+    return _decorator
+
+
+def _single_page_from(api_result):
+    """ Reduce a one type search to its single page of results. """
+    # in our distilled api, we're only expecting one type of returned data
+    # so the tekore tuple should be length one
+    assert len(api_result) == 1
+    return search_object_from(api_result[0])
 
 class Provider():
     """ Wrap the third party api module and provide simple objects for JSON service. 
@@ -209,11 +281,9 @@ class Provider():
         if memoize:
             # create cache dir if it does not exist
             CACHE.mkdir(parents=True, exist_ok=True)
-            factory = TekoreAdaptor
         else:
-            # clear cache and do not use
+            # clear cache and do not recreate, permacache skips the missing dir
             shutil.rmtree(CACHE, ignore_errors=True)
-            factory = tekore.Spotify
 
         try:
             self.token = self._token_load()
@@ -221,10 +291,13 @@ class Provider():
         except tekore.BadRequest as err:
             self.token = None
 
-        self.spotify = factory(token=self.token,
-            sender=tekore.CachingSender(max_size=256, 
+        self.spotify = tekore.Spotify(token=self.token,
+            sender=tekore.CachingSender(max_size=256,
                 sender=tekore.PersistentSender()))  # chained senders
 
+        # pool for overlapping the independent api calls in detail methods
+        self._pool = ThreadPoolExecutor(max_workers=4)
+
     @staticmethod
     def _token_load():
         """ Load persisted token from last session or request new token. """
@@ -233,17 +306,17 @@ class Provider():
             with TOKEN.open('rb') as fp:
                 token = pickle.load(fp)
             token_value = token.access_token[:8]
-            logging.info("obtained token %s... from file", token_value)
+            _log.info("obtained token %s... from file", token_value)
             return token
         except FileNotFoundError as err:
             # no file but not necessarily an error
-            logging.warning('no token file found, requesting new')
+            _log.warning('no token file found, requesting new')
         except (pickle.PickleError, EOFError) as err:
             # file exists but could not un-pickle
-            logging.error('%s reading token, requesting new', err)
+            _log.error('%s reading token, requesting new', err)
         except AttributeError as err:
             # file unpickled but it was not a token
-            logging.error('%s using token, requesting new', err)
+            _log.error('%s using token, requesting new', err)
 
         try:
             # request new token with external credentials
@@ -252,11 +325,11 @@ class Provider():
             return tekore.request_client_token(**credentials)
         except FileNotFoundError as err:
             # no file for credentials, cannot proceed
-            logging.critical('Credentials not found at %s', CREDENTIALS.absolute())
+            _log.critical('Credentials not found at %s', CREDENTIALS.absolute())
             raise err
         except tekore.HTTPError as err:
             # problem requesting token with credentials
-            logging.critical('%s requesting token', err)
+            _log.critical('%s requesting token', err)
             raise err
 
     @staticmethod
@@ -264,44 +337,68 @@ class Provider():
         """ Save token for next session. """
         try:
             with TOKEN.open('wb') as fp:
-                pickle.dump(token, fp)
-                logging.info('saved token to file')
+                pickle.dump(token, fp, protocol=pickle.HIGHEST_PROTOCOL)
+                _log.info('saved token to file')
         except FileNotFoundError:
             # directory for token does not exist, skip save
-            logging.debug('no cache dir, token not saved')
+            _log.debug('no cache dir, token not saved')
+
+    # cached helpers wrapping individual api endpoints, each stores the
+    # transformed serializable object so a cache hit never touches tekore
+    @permacache(transform=_single_page_from)
+    def _search(self, **kwargs):
+        return self.spotify.search(**kwargs)
+
+    @permacache(transform=detail_object_from)
+    def _artist(self, **kwargs):
+        return self.spotify.artist(**kwargs)
+
+    @permacache(transform=search_object_from)
+    def _artist_albums(self, **kwargs):
+        return self.spotify.artist_albums(**kwargs)
+
+    @permacache(transform=detail_object_from)
+    def _album(self, **kwargs):
+        return self.spotify.album(**kwargs)
+
+    @permacache(transform=search_object_from)
+    def _album_tracks(self, **kwargs):
+        return self.spotify.album_tracks(**kwargs)
+
+    @permacache(transform=detail_object_from)
+    def _track(self, **kwargs):
+        return self.spotify.track(**kwargs)
+
+    @permacache(transform=detail_object_from)
+    def _track_audio_features(self, **kwargs):
+        return self.spotify.track_audio_features(**kwargs)
 
     def search(self, qtype, query):
         """ Perform a search `query` for items of `qtype`. """
-        api_result = self.spotify.search(query=query, types=(qtype,))
-        # in our distilled api, we're only expecting one type of returned data
-        # so the tekore tuple should be length one
-        assert len(api_result) == 1
-        return search_object_from(api_result[0])
+        return self._search(query=query, types=(qtype,))
 
     def artist(self, artist_id):
         """ Return detail about artist and a list of their albums. """
-        api_artist = self.spotify.artist(artist_id=artist_id)
-        api_albums = self.spotify.artist_albums(artist_id=artist_id)
-        return {'artist': detail_object_from(api_artist),
-                'albums': search_object_from(api_albums)}
+        # the two endpoint calls are independent, overlap their round-trips
+        albums = self._pool.submit(self._artist_albums, artist_id=artist_id)
+        return {'artist': self._artist(artist_id=artist_id),
+                'albums': albums.result()}
 
     def album(self, album_id):
         """ Return detail about album and a list of its tracks. """
-        api_album = self.spotify.album(album_id=album_id)
-        api_tracks = self.spotify.album_tracks(album_id=album_id)
-        return {'album': detail_object_from(api_album),
-                'tracks': search_object_from(api_tracks)}
+        tracks = self._pool.submit(self._album_tracks, album_id=album_id)
+        return {'album': self._album(album_id=album_id),
+                'tracks': tracks.result()}
 
     def track(self, track_id):
         """ Return detail about a track."""
-        api_track = self.spotify.track(track_id=track_id)
-        api_features = self.spotify.track_audio_features(track_id=track_id)
-        return {'track': detail_object_from(api_track),
-                'audio': detail_object_from(api_features) }
+        audio = self._pool.submit(self._track_audio_features, track_id=track_id)
+        return {'track': self._track(track_id=track_id),
+                'audio': audio.result()}
 
 if __name__ == '__main__':
     # module level test code
-    logging.info("begin")
+    _log.info("begin")
     p = Provider()
     a = p.search(query='come away with me', qtype='album')
     print(a[0])
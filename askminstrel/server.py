@@ -13,9 +13,16 @@ import logging
 from pathlib import Path
 import cherrypy
 
-from .provider import Provider
+from .provider import Provider, _json_dumps
 from .vanilla import VanillaUI
 
+_log = logging.getLogger(__name__)
+
+def _orjson_handler(*args, **kwargs):
+    """ json_out handler serializing with orjson, emits bytes directly. """
+    value = cherrypy.serving.request._json_inner_handler(*args, **kwargs)  # pylint: disable=protected-access
+    return _json_dumps(value)
+
 class Minstrel():
     """ Create endpoints for provider API. """
     # pylint: disable=no-self-use
@@ -27,6 +34,8 @@ class Minstrel():
         self.track = Track(provider)
 
     @cherrypy.expose
+    # force=True since the expires tool runs before etags provides a validator
+    @cherrypy.tools.expires(secs=86400, force=True)
     def index(self):
         """ Show landing page with links. """
         return """
@@ -44,7 +53,7 @@ class Minstrel():
         raise cherrypy.InternalRedirect('/docs')
 
 @cherrypy.expose
-@cherrypy.tools.json_out()
+@cherrypy.tools.json_out(handler=_orjson_handler)
 @cherrypy.popargs('qtype', 'query')
 class Search():
     """ Provide REST API for client searches.
@@ -63,18 +72,19 @@ class Search():
         * GET /search/{qtype}/{query}
         * GET /search?qtype={}&query={}
         """
-        logging.info("<%s>: invoked with %s", self.__class__.__name__, str((qtype,query)))
+        _log.info("<%s>: invoked with %s", self.__class__.__name__, str((qtype,query)))
 
         if qtype not in ('artist', 'album', 'track'):
             raise cherrypy.HTTPError(404)
 
         payload = {qtype: self._provider.search(qtype, query)}
-        logging.debug("returning %s ...abridged ... %s",
-            str(payload)[:63], str(payload)[-31:])
+        if _log.isEnabledFor(logging.DEBUG):
+            s = str(payload)
+            _log.debug("returning %s ...abridged ... %s", s[:63], s[-31:])
         return payload
 
 @cherrypy.expose
-@cherrypy.tools.json_out()
+@cherrypy.tools.json_out(handler=_orjson_handler)
 @cherrypy.popargs('item_id')
 class Artist():
     """ Provide REST API for Artist detail.
@@ -91,15 +101,16 @@ class Artist():
             * GET /artist/{item_id}
             * GET /artist?item_id={}
         """
-        logging.info("<%s>: invoked with %s", self.__class__.__name__, item_id)
+        _log.info("<%s>: invoked with %s", self.__class__.__name__, item_id)
 
         payload = self._provider.artist(item_id)
-        logging.debug("returning %s ...abridged ... %s",
-            str(payload)[:63], str(payload)[-31:])
+        if _log.isEnabledFor(logging.DEBUG):
+            s = str(payload)
+            _log.debug("returning %s ...abridged ... %s", s[:63], s[-31:])
         return payload
 
 @cherrypy.expose
-@cherrypy.tools.json_out()
+@cherrypy.tools.json_out(handler=_orjson_handler)
 @cherrypy.popargs('item_id')
 class Album():
     """ Provide REST API for Album detail.
@@ -116,15 +127,16 @@ class Album():
             * GET /album/{item_id}
             * GET /album?item_id={}
         """
-        logging.info("<%s>: invoked with %s", self.__class__.__name__, item_id)
+        _log.info("<%s>: invoked with %s", self.__class__.__name__, item_id)
 
         payload = self._provider.album(item_id)
-        logging.debug("returning %s ...abridged ... %s",
-            str(payload)[:63], str(payload)[-31:])
+        if _log.isEnabledFor(logging.DEBUG):
+            s = str(payload)
+            _log.debug("returning %s ...abridged ... %s", s[:63], s[-31:])
         return payload
 
 @cherrypy.expose
-@cherrypy.tools.json_out()
+@cherrypy.tools.json_out(handler=_orjson_handler)
 @cherrypy.popargs('item_id')
 class Track():
     """ Provide REST API for Track detail.
@@ -141,17 +153,19 @@ class Track():
             * GET /track/{item_id}
             * GET /track?item_id={}
         """
-        logging.info("<%s>: invoked with %s", self.__class__.__name__, item_id)
+        _log.info("<%s>: invoked with %s", self.__class__.__name__, item_id)
 
         payload = self._provider.track(item_id)
-        logging.debug("returning %s ...abridged ... %s",
-            str(payload)[:63], str(payload)[-31:])
+        if _log.isEnabledFor(logging.DEBUG):
+            s = str(payload)
+            _log.debug("returning %s ...abridged ... %s", s[:63], s[-31:])
         return payload
 
 
 def minstrel_server(port=50861, memoize=True):
     """ Configure and launch application server. """
-    minstrel = Minstrel(Provider(memoize=memoize))
+    provider = Provider(memoize=memoize)
+    minstrel = Minstrel(provider)
     # register all subapps in Minstrel for method dispatch (GET, PUT, POST, etc.)
     dispatch = {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}
     restful = {'/'+url : dispatch for url in minstrel.__dict__}
@@ -160,12 +174,24 @@ def minstrel_server(port=50861, memoize=True):
             'log.screen': False,
             'server.socket_port': port,
             'server.socket_timeout': 60,  # MAKE SOCKET NON-BLOCKING
+            'server.thread_pool': 32,
+            'server.thread_pool_max': 64,
+            'server.socket_queue_size': 30,
+            'server.nodelay': True,
             'engine.autoreload.on': False,
             'tools.staticdir.root': Path.cwd()
         },
         '/':{
             'tools.sessions.on': True,
-            'tools.sessions.timeout': 60
+            'tools.sessions.timeout': 60,
+            # validate ETags so constant pages answer 304 on repeat visits
+            'tools.etags.on': True,
+            'tools.etags.autotags': True,
+            # html tables and search json compress several-fold on the wire
+            'tools.gzip.on': True,
+            'tools.gzip.mime_types': ['text/html', 'application/json',
+                'application/javascript'],
+            'tools.gzip.compress_level': 5
         },
         '/docs': {
             'tools.staticdir.on': True,
@@ -182,7 +208,16 @@ def minstrel_server(port=50861, memoize=True):
     config.update(restful)
     # register Vanilla UI as a separate cherrypy app with standard dispatch/routing
     # this could even be on another server if taking a microservice approach
-    cherrypy.tree.mount(VanillaUI(), '/vanilla', {'/':{'tools.sessions.on': True}}
+    # the Vanilla app shares the Provider instance so its handlers can call
+    # the api layer in-process rather than looping back over http
+    cherrypy.tree.mount(VanillaUI(provider), '/vanilla',
+        {'/':{'tools.sessions.on': True,
+            # validate ETags so the constant form page answers 304
+            'tools.etags.on': True,
+            'tools.etags.autotags': True,
+            'tools.gzip.on': True,
+            'tools.gzip.mime_types': ['text/html'],
+            'tools.gzip.compress_level': 5}}
     )
     cherrypy.quickstart(minstrel, '/', config)
 
@@ -8,118 +8,161 @@ SWENG861 Project, AskMinstrel
 """
 # pylint: disable=bad-continuation, invalid-name
 import logging
+from collections import OrderedDict
 from functools import wraps
 import cherrypy
-import requests
+
+from .provider import Provider, _json_dumps, _json_loads
+
+_log = logging.getLogger(__name__)
+
+_PAGE_HEADER = '\n'.join(('<!DOCTYPE html><HTML>',
+    '<style>',
+        'body {font-family: sans-serif}',
+        'dt {font-weight: bold; margin-top: 0.5em;}'
+        'footer {font-style: italic}',
+    '</style>',
+    '<header><H1>AskMinstrel Vanilla</H1>',
+    '<nav>',
+    ' | '.join((
+        '<a href="/">Home</a>',
+        '<a href="/vanilla">Search</a>',
+        '<a href="/help">Documentation</a>'
+    )),
+    '</nav></header><hr>\n'))
+
+_PAGE_FOOTER = '\n<hr><footer>PSU SWENG861 Project - AMWagner</footer>\n</HTML>'
 
 def vanilla_page(f):
-    """ Decorator to wrap pages in header/footer template. """
+    """ Decorator to wrap page fragment generators in header/footer template.
+
+    The wrapped function must yield HTML fragments; the result streams so
+    CherryPy can flush chunks while later fragments are still being built.
+    """
     @wraps(f)
     def _wrapper(*args, **kwargs):
-        return '\n'.join(('<!DOCTYPE html><HTML>',
-            '<style>',
-                'body {font-family: sans-serif}',
-                'dt {font-weight: bold; margin-top: 0.5em;}'
-                'footer {font-style: italic}',
-            '</style>',
-            '<header><H1>AskMinstrel Vanilla</H1>',
-            '<nav>',
-            ' | '.join((
-                '<a href="/">Home</a>',
-                '<a href="/vanilla">Search</a>',
-                '<a href="/help">Documentation</a>'
-            )),
-            '</nav></header><hr>',
-            f(*args, **kwargs),
-            '<hr><footer>PSU SWENG861 Project - AMWagner</footer>',
-            '</HTML>'))
+        yield _PAGE_HEADER
+        yield from f(*args, **kwargs)
+        yield _PAGE_FOOTER
     return _wrapper
 
 
+# reusable cell templates, compiled format specs are cached on the str object
+# and keep the markup in one place should escaping ever be added centrally
+_TD_NAME_TMPL = '<td><a href=/vanilla/detail/{rt}/{id}>{v}</a></td>'
+_TD_IMG_TMPL = "<td><img src={v} style='width:64px;height:64px;'></td>"
+_TD_PLAIN_TMPL = '<td>{v}</td>'
+_DTDD_IMG_TMPL = "<dt>{k}</dt><dd><img src={v} style='width:320x;height:320px;'></dd>"
+_DTDD_LINK_TMPL = '<dt>{k}</dt><dd><a href=/vanilla/detail/{rt}/{id}>{v}</a></dd>'
+_DTDD_METER_TMPL = '<dt>{k}</dt><dd><meter max=1.0 value={v}></meter></dd>'
+_DTDD_PLAIN_TMPL = '<dt>{k}</dt><dd>{v}</dd>'
+
 def render_detail_as_html(result_type, result_dict):
-    """ Create an item detail component using <DL>. """
+    """ Generate an item detail component using <DL>. """
 
     def _dtdd_generator(result_item):
         """ Generate <DT> and <DD> tags with appropriate content for each item. """
         for k, v in result_item.items():
             if k == 'images':
-                yield f"<dt>{k.title()}</dt><dd><img src={v} style='width:320x;height:320px;'></dd>"
+                yield _DTDD_IMG_TMPL.format_map({'k': k.title(), 'v': v})
             elif k == 'id':
                 pass
             elif isinstance(v, dict):
                 # Expect a dict to represent an item url to construct
-                yield f"<dt>{k.title()}</dt><dd><a href=/vanilla/detail/{v['type']}/{v['id']}>{v['name']}</a></dd>"
+                yield _DTDD_LINK_TMPL.format_map(
+                    {'k': k.title(), 'rt': v['type'], 'id': v['id'], 'v': v['name']})
             elif result_type == 'audio' and isinstance(v, float):
-                yield f"<dt>{k.title()}</dt><dd><meter max=1.0 value={v}></meter></dd>"
+                yield _DTDD_METER_TMPL.format_map({'k': k.title(), 'v': v})
             else:
-                yield f"<dt>{k.title()}</dt><dd>{v}</dd>"
+                yield _DTDD_PLAIN_TMPL.format_map({'k': k.title(), 'v': v})
+
+    yield f'<H2>{result_type.title()} Details</H2><dl>'
+    yield from _dtdd_generator(result_dict)
+    yield '</dl>'
 
-    output = f'<H2>{result_type.title()} Details</H2><dl>'
-    output += ''.join(_dtdd_generator(result_dict))
-    output += '</dl>'
-    return output
+def _pick_td_renderer(result_type, key, value):
+    """ Choose a <TD> renderer for `key` from the shape of the first item.
+
+    Search results share one schema per query, so the per-cell branching can
+    run once up front and the row loop just calls the chosen renderers.
+    """
+    if key == 'name':
+        # Every item has name and id from which a url can be constructed
+        def _td(item):
+            return _TD_NAME_TMPL.format_map(
+                {'rt': result_type, 'id': item['id'], 'v': item['name']})
+    elif key == 'images':
+        # Don't provide alt attr so that spacing remains consistent
+        def _td(item):
+            return _TD_IMG_TMPL.format_map({'v': item['images']})
+    elif isinstance(value, dict):
+        # Expect a dict to represent an item url to construct
+        def _td(item):
+            v = item[key]
+            try:
+                return _TD_NAME_TMPL.format_map(
+                    {'rt': v['type'], 'id': v['id'], 'v': v['name']})
+            except TypeError:
+                # occasional item missing the nested model, show as plain datum
+                return _TD_PLAIN_TMPL.format_map({'v': v})
+    else:
+        def _td(item):
+            return _TD_PLAIN_TMPL.format_map({'v': item[key]})
+    return _td
 
 def render_search_as_html(result_type, result_list):
-    """ Create a search list component using <TABLE>. """
+    """ Generate a search list component using <TABLE>. """
 
     def _th_generator(result_item):
         """ Generate <TH> tags from the item keys. """
         yield from (f"<th>{k.title()}</th>" for k in result_item.keys() if k != 'id')
 
-    def _td_generator(result_item):
-        """ Generate <TD> tags for each datum in an item. """
-        for k, v in result_item.items():
-            if k == 'name':
-                # Every item has name and id from which a url can be constructed
-                yield f"<td><a href=/vanilla/detail/{result_type}/{result_item['id']}>{v}</a></td>"
-            elif k == 'images':
-                # Don't provide alt attr so that spacing remains consistent
-                yield f"<td><img src={v} style='width:64px;height:64px;'></td>"
-            elif k == 'id':
-                pass
-            elif isinstance(v, dict):
-                # Expect a dict to represent an item url to construct
-                yield f"<td><a href=/vanilla/detail/{v['type']}/{v['id']}>{v['name']}</a></td>"
-            else:
-                yield f"<td>{v}</td>"
-
     try:
         assert 'id' in result_list[0].keys()
         assert 'name' in result_list[0].keys()
     except IndexError:
         # empty list means no search results
-        output = f'No matching {result_type} found.'
+        yield f'No matching {result_type} found.'
+        return
     except AssertionError:
         # malformed data likely a change in content provider
         raise cherrypy.HTTPError(500)
-    else:
-        output = f'<H2>{result_type.title()} Search Results</H2><table>'
-        output += '<tr>'+''.join(th for th in _th_generator(result_list[0]))+'</tr>'
-        for result_item in result_list:
-            output += '<tr>'+''.join(td for td in _td_generator(result_item))+'</tr>'
-        output += '</table>'
-    return output
+
+    renderers = [_pick_td_renderer(result_type, key, value)
+        for key, value in result_list[0].items() if key != 'id']
+
+    yield f'<H2>{result_type.title()} Search Results</H2><table>'
+    yield '<tr>'
+    yield from _th_generator(result_list[0])
+    yield '</tr>'
+    for result_item in result_list:
+        yield '<tr>'
+        for render in renderers:
+            yield render(result_item)
+        yield '</tr>'
+    yield '</table>'
 
 @vanilla_page
 def render_data_as_html(api_data):
-    """ Convert JSON data from the api into static html.
+    """ Convert JSON data from the api into streamed html.
 
     The api will have returned a dict of one or more items (k, v pair).  Treat a
     dict item as a detail page component.  Treat a list as a search list component.
     """
-    def _component_generator():
-        for k, v in api_data.items():
-            if isinstance(v, list):
-                yield render_search_as_html(k, v)
-            else:
-                yield render_detail_as_html(k, v)
-
-    return '<hr>'.join(_component_generator())
+    separate = False
+    for k, v in api_data.items():
+        if separate:
+            yield '<hr>'
+        separate = True
+        if isinstance(v, list):
+            yield from render_search_as_html(k, v)
+        else:
+            yield from render_detail_as_html(k, v)
 
 @vanilla_page
 def render_form_as_html():
-    """ Create HTML for the search form page. """
-    return """
+    """ Generate HTML for the search form page. """
+    yield """
         <form action="/vanilla/search" method="get">
             <h2>Search for</h2>
             <input type="radio" id="artist" name="qtype" value="artist" checked>
@@ -147,32 +190,70 @@ def render_form_as_html():
         </form>
     """
 
+# the search form never changes, render it once at import
+_FORM_HTML = ''.join(render_form_as_html())
+
+# rendered page LRU keyed by the payload frozen to JSON bytes
+_RENDERED = OrderedDict()
+_RENDERED_SIZE = 256
+
+def _render_cached(frozen_payload):
+    """ Memoize whole rendered pages by their frozen api payload.
+
+    Rendering is a pure function of the payload, so repeat visits to
+    popular searches and details cost one dict lookup instead of all the
+    generator walks.  A hit returns the joined page string; a miss returns
+    a generator that streams the render and stores the joined page once
+    fully delivered, preserving the chunked first-view path.
+    """
+    try:
+        _RENDERED.move_to_end(frozen_payload)
+        return _RENDERED[frozen_payload]
+    except KeyError:
+        pass
+
+    def _stream_and_store():
+        fragments = []
+        for fragment in render_data_as_html(_json_loads(frozen_payload)):
+            fragments.append(fragment)
+            yield fragment
+        _RENDERED[frozen_payload] = ''.join(fragments)
+        if len(_RENDERED) > _RENDERED_SIZE:
+            _RENDERED.popitem(last=False)
+    return _stream_and_store()
+
 class VanillaUI():
     """ Create endpoints for the Vanilla HTML interface. """
     # pylint: disable=no-self-use
-    def __init__(self):
-        self.requests = requests.Session()
-        self.requests.headers.update({'Keep-Alive': 'timeout=60'})
+    def __init__(self, provider: Provider):
+        self._provider = provider
 
     @cherrypy.expose
+    # force=True since the expires tool runs before etags provides a validator
+    @cherrypy.tools.expires(secs=86400, force=True)
     def index(self):
         """ Show search form at application base '/vanilla' """
-        return render_form_as_html()
+        return _FORM_HTML
 
     @cherrypy.expose
+    # etag autotags would collapse the streamed body, keep it off here
+    @cherrypy.tools.etags(on=False)
     def search(self, **kwargs):
-        """ Handle search form submission by requesting from JSON service. """
-        logging.info(">=>")
-        logging.info("invoked with %s", str(kwargs))
-        # in the context of cherrypy.request, this handler is at
-        # base + script_name + path_info + query_string
-        # aka: ip:port + vanilla + search + qtype=xx&query=yy
-        api_url = cherrypy.request.base + cherrypy.request.path_info + '?' + cherrypy.request.query_string
-        r = self.requests.get(api_url)
-        r.raise_for_status()
-        return render_data_as_html(r.json())
+        """ Handle search form submission with an in-process provider call. """
+        _log.info(">=>")
+        _log.info("invoked with %s", str(kwargs))
+        # calling the shared Provider directly skips the loopback round-trip
+        # to the JSON service and its encode/parse of the same payload
+        qtype = kwargs.get('qtype')
+        if qtype not in ('artist', 'album', 'track'):
+            raise cherrypy.HTTPError(404)
+        payload = {qtype: self._provider.search(qtype, kwargs['query'])}
+        cherrypy.response.stream = True
+        return _render_cached(_json_dumps(payload))
 
     @cherrypy.expose
+    # etag autotags would collapse the streamed body, keep it off here
+    @cherrypy.tools.etags(on=False)
     @cherrypy.popargs('qtype', 'qid')
     def detail(self, qtype, qid):
         """ Handle all detail urls constructed in HTML.  For instance,
@@ -181,15 +262,13 @@ class VanillaUI():
         `qtype` is one of (artist, album, track) and
         `qid` is a unique identifier
          """
-        logging.info(">=>")
-        logging.info("invoked with %s", '/'.join((qtype, qid)))
-        # in the context of cherrypy.request, this handler is at
-        # base + script_name + path_info + query_string
-        # aka: ip:port + vanilla + detail + qtype + qid
-        # want ip:port + qtype + qid
-        # note, need to remove pluralization or add url aliases specifically
-        # albums->album, artists->artist, track->tracks
-        api_url = '/'.join((cherrypy.request.base, qtype.rstrip('s'), qid))
-        r = self.requests.get(api_url)
-        r.raise_for_status()
-        return render_data_as_html(r.json())
+        _log.info(">=>")
+        _log.info("invoked with %s", '/'.join((qtype, qid)))
+        # note, need to remove pluralization since detail urls constructed
+        # from search tables may use albums->album, artists->artist, etc.
+        qtype = qtype.rstrip('s')
+        if qtype not in ('artist', 'album', 'track'):
+            raise cherrypy.HTTPError(404)
+        payload = getattr(self._provider, qtype)(qid)
+        cherrypy.response.stream = True
+        return _render_cached(_json_dumps(payload))